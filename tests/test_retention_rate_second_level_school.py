@@ -1,11 +1,15 @@
 import pytest
 import pandas as pd
+import io
+import hashlib
+import json
 import os
 import requests
 import shutil
 import sys 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from retention_rate_second_level_school import transform_and_aggregate, save_data, download_and_load_data
+import retention_rate_second_level_school
+from retention_rate_second_level_school import transform_and_aggregate, save_data, download_and_load_data, download_data, main, DATA_URL, TRANSFORM_VERSION
 from unittest.mock import patch, MagicMock
 
 # --- Configuration for Tests ---
@@ -52,6 +56,13 @@ def cleanup_files():
     if os.path.exists(OUTPUT_DIR):
         shutil.rmtree(OUTPUT_DIR)
 
+@pytest.fixture(autouse=True)
+def isolated_download_cache(tmp_path, monkeypatch):
+    """
+    Fixture pointing the raw download cache at a per-test temporary directory.
+    """
+    monkeypatch.setattr('retention_rate_second_level_school.CACHE_DIR', str(tmp_path / 'cache'))
+
 # --- Test Functions ---
 
 def test_filtering_and_lowercasing(mock_raw_df):
@@ -68,6 +79,7 @@ def test_filtering_and_lowercasing(mock_raw_df):
     expected_cols = ['five_year_period', 'sex_category', 'retention_count']
     assert list(result_df.columns) == expected_cols
     assert len(result_df) == 6, "Expected 6 aggregated rows after filtering and grouping."
+    assert result_df['retention_count'].dtype == 'int64'
 
 def test_grouping_and_summation_with_right_false(mock_raw_df):
     """
@@ -109,7 +121,7 @@ def test_save_data():
     mock_parquet_path = os.path.join(OUTPUT_DIR, f'{mock_base_name}.parquet')
 
     mock_df = pd.DataFrame({'Period': ['A', 'B'], 'Count': [10, 20]})
-    save_data(mock_df, mock_base_name)
+    assert save_data(mock_df, mock_base_name) is True
 
     # Assertions for file existence in the correct subdirectory
     assert os.path.exists(OUTPUT_DIR)
@@ -124,6 +136,20 @@ def test_save_data():
     df_parquet = pd.read_parquet(mock_parquet_path)
     assert df_parquet.equals(mock_df)
 
+def test_save_data_parquet_only():
+    """
+    Tests that save_data skips the CSV output when write_csv is False.
+    """
+    mock_base_name = 'test_output_parquet_only'
+    mock_csv_path = os.path.join(OUTPUT_DIR, f'{mock_base_name}.csv')
+    mock_parquet_path = os.path.join(OUTPUT_DIR, f'{mock_base_name}.parquet')
+
+    mock_df = pd.DataFrame({'Period': ['A', 'B'], 'Count': [10, 20]})
+    save_data(mock_df, mock_base_name, write_csv=False)
+
+    assert not os.path.exists(mock_csv_path)
+    assert pd.read_parquet(mock_parquet_path).equals(mock_df)
+
 
 @patch('retention_rate_second_level_school.requests.get')
 def test_download_success_with_bom_fix(mock_get):
@@ -134,12 +160,13 @@ def test_download_success_with_bom_fix(mock_get):
     mock_response = MagicMock()
     mock_response.status_code = 200
     
-    # Simulate a CSV where the first column header has a BOM/quote issue (handled by pd.read_csv + rename)
-    # The actual rename occurs after read_csv, targeting df.columns[0]
-    csv_content = 'STATISTIC,"Statistic Label",Year,VALUE\nEDA14C1,"First Year",2020,1000\nTotal,"Total Students",2021,2000'
-    mock_response.text = csv_content
+    # Simulate a streamed UTF-8 CSV body whose first column header starts with a BOM
+    # (stripped by the utf-8-sig header peek and by pyarrow.csv.read_csv, then df.columns[0] is renamed to 'statistic')
+    csv_content = b'\xef\xbb\xbfSTATISTIC,"Statistic Label",Year,VALUE\nEDA14C1,"First Year",2020,1000\nTotal,"Total Students",2021,2000'
+    mock_response.raw = io.BytesIO(csv_content)
+    mock_response.headers = {}
     mock_response.raise_for_status.return_value = None
-    mock_get.return_value = mock_response
+    mock_get.return_value.__enter__.return_value = mock_response
 
     # 2. Call the function
     df = download_and_load_data(MOCK_URL)
@@ -151,6 +178,141 @@ def test_download_success_with_bom_fix(mock_get):
     assert 'statistic' in df.columns 
     assert df['statistic'].iloc[0] == 'EDA14C1'
     assert df['VALUE'].iloc[0] == 1000 # Verify value integrity
+    # Verify the raw input hash used to skip unchanged re-runs is recorded
+    assert df.attrs['source_hash'] == hashlib.blake2b(csv_content, digest_size=16).hexdigest()
+
+@patch('retention_rate_second_level_school.requests.get')
+def test_download_applies_schema_and_skips_unused_columns(mock_get):
+    """
+    Tests that only the columns used by the pipeline are loaded, with the explicit dtypes from RAW_SCHEMA.
+    """
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    csv_content = (
+        b'\xef\xbb\xbf"STATISTIC","Statistic Label","Type of School","Sex","Year","UNIT","VALUE"\n'
+        b'"EDA14C1","First Year","All schools","Male","2020","Number","1000"\n'
+    )
+    mock_response.raw = io.BytesIO(csv_content)
+    mock_response.headers = {}
+    mock_response.raise_for_status.return_value = None
+    mock_get.return_value.__enter__.return_value = mock_response
+
+    df = download_and_load_data(MOCK_URL)
+
+    assert list(df.columns) == ['statistic', 'Statistic Label', 'Sex', 'Year', 'UNIT', 'VALUE']
+    assert df['Year'].dtype == 'int32'
+    assert df['VALUE'].dtype == 'float32'
+    assert isinstance(df['Sex'].dtype, pd.CategoricalDtype)
+
+@patch('retention_rate_second_level_school.requests.get')
+def test_downloaded_data_aggregates_in_sorted_order(mock_get):
+    """
+    Tests that rows are ordered by period and then alphabetically by sex, regardless of the order sexes appear in the file.
+    """
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    rows = ''.join(
+        f'"EDA14C1","Entrants to First Year","{sex}","{year}","Number","10"\n'
+        for year in (2010, 2015) for sex in ('Both sexes', 'Male', 'Female')
+    )
+    csv_content = ('"STATISTIC","Statistic Label","Sex","Year","UNIT","VALUE"\n' + rows).encode('utf-8')
+    mock_response.raw = io.BytesIO(csv_content)
+    mock_response.headers = {}
+    mock_response.raise_for_status.return_value = None
+    mock_get.return_value.__enter__.return_value = mock_response
+
+    df_result = transform_and_aggregate(download_and_load_data(MOCK_URL))
+
+    assert list(df_result['five_year_period']) == ['2010-2014'] * 3 + ['2015-2019'] * 3
+    assert list(df_result['sex_category'].astype(str)) == ['Both sexes', 'Female', 'Male'] * 2
+
+@patch('retention_rate_second_level_school.requests.get')
+def test_downloaded_blank_year_and_placeholder_value_are_dropped(mock_get):
+    """
+    Tests that a row with an empty Year is dropped instead of producing a bogus five-year period,
+    and that a '..' VALUE placeholder is read as missing instead of failing the whole load.
+    """
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    mock_response.raw = io.BytesIO(
+        b'"STATISTIC","Statistic Label","Sex","Year","UNIT","VALUE"\n'
+        b'"EDA14C1","Entrants to First Year","Male","2010","Number","10"\n'
+        b'"EDA14C1","Entrants to First Year","Male","","Number","99"\n'
+        b'"EDA14C1","Entrants to First Year","Male","2011","Number",".."\n'
+    )
+    mock_response.headers = {}
+    mock_response.raise_for_status.return_value = None
+    mock_get.return_value.__enter__.return_value = mock_response
+
+    df_result = transform_and_aggregate(download_and_load_data(MOCK_URL))
+
+    assert list(df_result['five_year_period']) == ['2010-2014']
+    assert list(df_result['retention_count']) == [10]
+
+@patch('retention_rate_second_level_school.requests.get')
+def test_download_rejects_unknown_value_token(mock_get):
+    """
+    Tests that a non-numeric VALUE other than the known null placeholders fails the load instead of being dropped.
+    """
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    mock_response.raw = io.BytesIO(
+        b'"STATISTIC","Statistic Label","Sex","Year","UNIT","VALUE"\n'
+        b'"EDA14C1","Entrants to First Year","Male","2010","Number","10"\n'
+        b'"EDA14C1","Entrants to First Year","Male","2011","Number","x"\n'
+    )
+    mock_response.headers = {}
+    mock_response.raise_for_status.return_value = None
+    mock_get.return_value.__enter__.return_value = mock_response
+
+    assert download_and_load_data(MOCK_URL) is None
+
+@patch('retention_rate_second_level_school.requests.get')
+def test_download_uses_cache_when_not_modified(mock_get):
+    """
+    Tests that a repeated download sends the cached ETag and reads the cached CSV when the server answers 304.
+    """
+    first_response = MagicMock()
+    first_response.status_code = 200
+    first_response.raw = io.BytesIO(b'STATISTIC,"Statistic Label",Year,VALUE\nEDA14C1,"First Year",2020,1000\n')
+    first_response.headers = {'ETag': '"abc123"'}
+    first_response.raise_for_status.return_value = None
+
+    not_modified_response = MagicMock()
+    not_modified_response.status_code = 304
+
+    mock_get.return_value.__enter__.side_effect = [first_response, not_modified_response]
+
+    first_df = download_and_load_data(MOCK_URL)
+    cached_df = download_and_load_data(MOCK_URL)
+
+    # The second request must be conditional on the ETag saved by the first
+    assert mock_get.call_args_list[1].kwargs['headers'] == {'If-None-Match': '"abc123"'}
+    not_modified_response.raise_for_status.assert_not_called()
+    assert cached_df.equals(first_df)
+    # The digest computed during the first download is reused, not recomputed, on the 304 path
+    assert cached_df.attrs['source_hash'] == first_df.attrs['source_hash']
+
+@patch('retention_rate_second_level_school.requests.get')
+def test_download_data_records_digest_without_parsing(mock_get, tmp_path):
+    """
+    Tests that download_data returns the digest of the raw bytes and stores it with the cache validators.
+    """
+    csv_content = b'STATISTIC,"Statistic Label",Year,VALUE\nEDA14C1,"First Year",2020,1000\n'
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    mock_response.raw = io.BytesIO(csv_content)
+    mock_response.headers = {'ETag': '"abc123"'}
+    mock_response.raise_for_status.return_value = None
+    mock_get.return_value.__enter__.return_value = mock_response
+
+    with patch('retention_rate_second_level_school.pacsv.read_csv') as mock_read_csv:
+        csv_path, source_hash = download_data(MOCK_URL)
+    mock_read_csv.assert_not_called()
+
+    assert source_hash == hashlib.blake2b(csv_content, digest_size=16).hexdigest()
+    with open(f'{csv_path}.json', encoding='utf-8') as f:
+        assert json.load(f) == {'etag': '"abc123"', 'last_modified': None, 'source_hash': source_hash}
 
 @patch('retention_rate_second_level_school.requests.get')
 def test_download_failure(mock_get):
@@ -161,10 +323,168 @@ def test_download_failure(mock_get):
     mock_response = MagicMock()
     mock_response.status_code = 404
     mock_response.raise_for_status.side_effect = requests.exceptions.HTTPError('404 Not Found')
-    mock_get.return_value = mock_response
+    mock_get.return_value.__enter__.return_value = mock_response
 
     # Call the function
     df = download_and_load_data(MOCK_URL)
     
     # Pytest assertion
     assert df is None
+
+# --- Tests for main() ---
+
+@pytest.fixture
+def pipeline_env(mock_raw_df, tmp_path, monkeypatch):
+    """
+    Fixture running main() against a temporary output directory, with the download patched to report a fixed
+    input hash and loading patched to return mock_raw_df.
+    Yields the paths of the Parquet output and its input hash sidecar.
+    """
+    output_dir = tmp_path / 'transformed'
+    monkeypatch.setattr('retention_rate_second_level_school.OUTPUT_DIR', str(output_dir))
+
+    def fake_load(csv_path, source_hash=None):
+        df = mock_raw_df.copy()
+        df.attrs['source_hash'] = source_hash
+        return df
+
+    with patch('retention_rate_second_level_school.download_data', autospec=True,
+               return_value=(str(tmp_path / 'raw.csv'), 'hash-of-current-input')), \
+         patch('retention_rate_second_level_school.load_data', autospec=True, side_effect=fake_load):
+        yield output_dir / f'{OUTPUT_FILE_NAME}.parquet', output_dir / f'{OUTPUT_FILE_NAME}.parquet.hash'
+
+def test_main_skips_transform_when_hash_matches(pipeline_env):
+    """
+    Tests that a second run with an unchanged input hash reuses the saved output without parsing or transforming again.
+    """
+    parquet_path, hash_path = pipeline_env
+    main()
+    assert hash_path.read_text() == f'hash-of-current-input:v{TRANSFORM_VERSION}'
+    retention_rate_second_level_school.load_data.reset_mock()
+
+    with patch('retention_rate_second_level_school.transform_and_aggregate', autospec=True) as mock_transform:
+        main()
+    retention_rate_second_level_school.load_data.assert_not_called()
+    mock_transform.assert_not_called()
+
+def test_main_transforms_when_hash_differs(pipeline_env):
+    """
+    Tests that a stale hash triggers the transformation and is replaced by the current input hash.
+    """
+    parquet_path, hash_path = pipeline_env
+    main()
+    hash_path.write_text('hash-of-previous-input')
+
+    with patch('retention_rate_second_level_school.transform_and_aggregate', autospec=True,
+               side_effect=transform_and_aggregate) as mock_transform:
+        main()
+    mock_transform.assert_called_once()
+    assert hash_path.read_text() == f'hash-of-current-input:v{TRANSFORM_VERSION}'
+
+def test_main_transforms_when_parquet_missing(pipeline_env):
+    """
+    Tests that a matching hash is ignored when the Parquet output it describes no longer exists.
+    """
+    parquet_path, hash_path = pipeline_env
+    main()
+    parquet_path.unlink()
+
+    with patch('retention_rate_second_level_school.transform_and_aggregate', autospec=True,
+               side_effect=transform_and_aggregate) as mock_transform:
+        main()
+    mock_transform.assert_called_once()
+    assert parquet_path.exists()
+
+def test_main_transforms_when_transform_version_changes(pipeline_env, monkeypatch):
+    """
+    Tests that outputs saved by a different transform version are rebuilt even though the input is unchanged.
+    """
+    parquet_path, hash_path = pipeline_env
+    main()
+    monkeypatch.setattr('retention_rate_second_level_school.TRANSFORM_VERSION', TRANSFORM_VERSION + 1)
+
+    with patch('retention_rate_second_level_school.transform_and_aggregate', autospec=True,
+               side_effect=transform_and_aggregate) as mock_transform:
+        main()
+    mock_transform.assert_called_once()
+    assert hash_path.read_text() == f'hash-of-current-input:v{TRANSFORM_VERSION + 1}'
+
+def test_main_transforms_when_csv_missing(pipeline_env):
+    """
+    Tests that a deleted CSV output is regenerated even when the hash and Parquet output are current.
+    """
+    parquet_path, hash_path = pipeline_env
+    csv_path = parquet_path.with_suffix('.csv')
+    main()
+    csv_path.unlink()
+
+    with patch('retention_rate_second_level_school.transform_and_aggregate', autospec=True,
+               side_effect=transform_and_aggregate) as mock_transform:
+        main()
+    mock_transform.assert_called_once()
+    assert csv_path.exists()
+
+def test_main_failed_save_leaves_no_hash(pipeline_env):
+    """
+    Tests that a previous hash is removed and not rewritten when saving fails.
+    """
+    parquet_path, hash_path = pipeline_env
+    main()
+    hash_path.write_text('hash-of-previous-input')
+
+    with patch('retention_rate_second_level_school.save_data', autospec=True, return_value=False):
+        main()
+    assert not hash_path.exists()
+
+def test_main_empty_result_leaves_no_hash(pipeline_env):
+    """
+    Tests that no hash is written when the transformation produces nothing to save.
+    """
+    parquet_path, hash_path = pipeline_env
+    with patch('retention_rate_second_level_school.transform_and_aggregate', autospec=True,
+               return_value=pd.DataFrame()):
+        main()
+    assert not parquet_path.exists()
+    assert not hash_path.exists()
+
+def test_main_runs_download_and_prepare_output(pipeline_env):
+    """
+    Tests that main runs both the download and the output preparation step.
+    """
+    with patch('retention_rate_second_level_school.prepare_output', autospec=True) as mock_prepare:
+        main()
+    mock_prepare.assert_called_once()
+    retention_rate_second_level_school.download_data.assert_called_once_with(DATA_URL)
+
+def test_main_continues_after_prepare_output_failure(pipeline_env):
+    """
+    Tests that a failed Parquet engine warm-up is reported but does not stop the pipeline.
+    """
+    parquet_path, hash_path = pipeline_env
+    with patch('retention_rate_second_level_school.prepare_output', autospec=True,
+               side_effect=ImportError('pyarrow.parquet unavailable')), \
+         patch('builtins.print') as mock_print:
+        main()
+    mock_print.assert_any_call('Warning: could not pre-load the Parquet engine: pyarrow.parquet unavailable')
+    assert parquet_path.exists()
+    assert hash_path.exists()
+
+@patch.dict(os.environ, {}, clear=False)
+def test_main_skips_verification_by_default(pipeline_env):
+    """
+    Tests that the saved Parquet file is not read back unless VERIFY_OUTPUT=1.
+    """
+    os.environ.pop('VERIFY_OUTPUT', None)
+    with patch('retention_rate_second_level_school.pd.read_parquet', autospec=True) as mock_read_parquet:
+        main()
+    mock_read_parquet.assert_not_called()
+
+@patch.dict(os.environ, {'VERIFY_OUTPUT': '1'})
+def test_main_verifies_output_when_enabled(pipeline_env):
+    """
+    Tests that VERIFY_OUTPUT=1 reads the saved Parquet file back.
+    """
+    parquet_path, hash_path = pipeline_env
+    with patch('retention_rate_second_level_school.pd.read_parquet', autospec=True) as mock_read_parquet:
+        main()
+    mock_read_parquet.assert_called_once_with(str(parquet_path))
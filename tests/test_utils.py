@@ -52,6 +52,17 @@ class TestUtils(unittest.TestCase):
         # The regex ensures the time value is a float with 2 decimal places.
         self.assertRegex(printed_output, r"Time taken for dummy_function: \d+\.\d{2} seconds",
                          "The format of the time measurement is incorrect.")
+
+    @patch.dict(os.environ, {'TIMED_CALL': '0'})
+    @patch('builtins.print')
+    def test_timed_call_silenced_by_env(self, mock_print):
+        """
+        Tests that setting TIMED_CALL=0 suppresses the timing message but still returns the result.
+        """
+        result = timed_call(dummy_function, 2, 3, delay=0)
+
+        self.assertEqual(result, 5)
+        mock_print.assert_not_called()
         
     def test_timed_call_executes_function(self):
         """
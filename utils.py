@@ -1,13 +1,16 @@
+import os
 import time
 
 # --- Utility Functions to calculate time taken by functions ---
 def timed_call(func, *args, **kwargs):
     """
     Utility to measure and print the time taken by a function call.
+    Uses a monotonic, nanosecond-resolution clock. Set the TIMED_CALL environment variable to '0' to silence the output.
     Returns the function's result.
     """
-    start = time.time()
+    start = time.perf_counter_ns()
     result = func(*args, **kwargs)
-    elapsed = time.time() - start
-    print(f"Time taken for {func.__name__}: {elapsed:.2f} seconds \n")
-    return result
\ No newline at end of file
+    elapsed_ns = time.perf_counter_ns() - start
+    if os.environ.get('TIMED_CALL', '1') != '0':
+        print(f"Time taken for {func.__name__}: {elapsed_ns / 1e9:.2f} seconds \n")
+    return result